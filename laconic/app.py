@@ -1,65 +1,89 @@
-"""Laconic app class, a WSGI application and a central object of each app.
+"""Laconic app class, a WSGI/ASGI application and a central object of each app.
 
 Laconic app object is a central object of every Laconic REST API (or other
 application) which brings together all the views, regions, handlers and
-extensions and provides the WSGI interface for the app to run on any of the
-Python WSGI application servers.
+extensions and provides the WSGI and ASGI interfaces for the app to run on any
+of the Python WSGI or ASGI application servers.
 
 Copyright:  (c) Zvonimir Jurelinac 2017
 License:    MIT, see LICENSE for more details
 """
 
+import asyncio
+import bisect
 import functools
+import inspect
 import logging
 import sys
+import threading
+from types import MappingProxyType
 
-from .context import Context
+from .context import AsyncContext, Context
 from .exceptions import APIInternalServerError
 from .routing import ExceptionHandler, Router
-from .utilities import AttributeScope, Config, SortedList, make_context_response
+from .utilities import _missing, AttributeScope, Config, SortedList, \
+    make_context_response, make_wsgi_environ, read_asgi_body, send_asgi_response
 
 
 class Laconic:
     """
-    Laconic application object - implements a WSGI application interface and
-    provides everything that is needed for routing, configuration, resource
-    management etc. of your app.
+    Laconic application object - implements WSGI and ASGI application
+    interfaces and provides everything that is needed for routing,
+    configuration, resource management etc. of your app.
     """
 
-    default_config = dict({
+    default_config = MappingProxyType({
         'APP_DEBUG': True,
         'LOG_FILENAME': 'laconic.log',
         'HTTP_AUTO_OPTIONS_RESPONSE': True,
+        'ROUTE_CACHE_SIZE': 1024,
     })
 
-    POSSIBLE_EVENTS = ['on_app_created',            # No extra hook arguments
-                       'on_context_init',           # Hook args: context
-                       'on_request_parsed',         # Hook args: request, context
-                       'on_endpoint_determined',    # Hook args: endpoint, request, context
-                       'on_response_generated',     # Hook args: response, context
-                       'on_context_finalize']       # Hook args: context
+    POSSIBLE_EVENTS = frozenset({
+        'on_app_created',           # No extra hook arguments, triggered once,
+                                    # before the first request (or ASGI
+                                    # lifespan startup) is handled
+        'on_context_init',          # Hook args: context
+        'on_request_parsed',        # Hook args: request, context
+        'on_endpoint_determined',   # Hook args: endpoint, request, context
+        'on_response_generated',    # Hook args: response, context
+        'on_context_finalize',      # Hook args: context
+    })
 
     EVENT_PRIO_MIN = -1
     EVENT_PRIO_MAX = 100
 
     def __init__(self, name, config=None, logger=None, routes=None, route_attrs=None):
         self.name = name
-        self.config = Config(self.default_config, **(config or {}))
+        self.config = Config(self.default_config)
+        if config:
+            self.config.update(config)
+        self._debug = self.config['DEBUG']
+        self._auto_options = self.config['HTTP_AUTO_OPTIONS_RESPONSE']
         self.logger = logger or self._create_logger()
         self.resources = object()
 
-        self.router = Router()
+        self.router = Router(self.config['ROUTE_CACHE_SIZE'])
         self.route_attrs = AttributeScope(route_attrs)
 
         if routes is not None:
             self.add_routes(routes)
 
         self.exception_handlers = []
+        self._exc_handlers_by_type = {}
+        self._exc_handler_cache = {}
         self.event_hooks = {k: SortedList() for k in Laconic.POSSIBLE_EVENTS}
+        self._hook_methods = {}
+        self._frozen_hooks = None
+        self._app_created_triggered = False
+        self._app_created_lock = threading.Lock()
+        self._app_created_async_lock = None
 
-        if self.config['HTTP_AUTO_OPTIONS_RESPONSE']:
+        if self._auto_options:
             self.add_event_hook('on_endpoint_determined',
-                                self._process_http_options, -1)
+                                self._process_http_options, -1, ['OPTIONS'])
+
+        self.logger.info('Application object created')
 
     # Public API-building routes
 
@@ -68,7 +92,7 @@ class Laconic:
         if methods is None:
             methods = ['GET']
 
-        if self.config['HTTP_AUTO_OPTIONS_RESPONSE'] and 'OPTIONS' not in methods:
+        if self._auto_options and 'OPTIONS' not in methods:
             methods.append('OPTIONS')
 
         if attrs is not None:
@@ -88,34 +112,105 @@ class Laconic:
     def add_exception_handler(self, exc_type, handler):
         """Add an exception handler to handle all runtime exceptions of a given
         type or subtype"""
-        self.exception_handlers.append(ExceptionHandler(exc_type, handler))
-        self.exception_handlers.sort()
+        exc_handler = ExceptionHandler(exc_type, handler)
+        bisect.insort(self.exception_handlers, exc_handler)
+        # As in the sorted list, the first handler added for a type wins
+        self._exc_handlers_by_type.setdefault(exc_type, exc_handler)
+        self._exc_handler_cache.clear()
 
     def add_exception_handlers(self, exc_handlers):
         """Add a list of exception handlers to the app"""
         for exc_type, handler in exc_handlers:
             self.add_exception_handler(exc_type, handler)
 
-    def add_event_hook(self, event, hook, priority=1):
-        """Add an event hook for a specific event"""
+    def add_event_hook(self, event, hook, priority=1, methods=None):
+        """
+        Add an event hook for a specific event, optionally only for requests
+        with one of the given HTTP `methods` - a hook can be added only once
+        for each event
+        """
         if event not in Laconic.POSSIBLE_EVENTS:
             raise KeyError('Unknown event type `%s`, cannot register a hook '
                            'for it' % event)
 
+        if methods is not None and event in ('on_app_created', 'on_context_init'):
+            raise KeyError('Event `%s` is triggered before the request is '
+                           'parsed, cannot register a method-specific hook '
+                           'for it' % event)
+
+        if hook in self.event_hooks[event]:
+            raise KeyError('Hook `%s` is already registered for event `%s`'
+                           % (getattr(hook, '__name__', hook), event))
+
         if priority < Laconic.EVENT_PRIO_MIN:
             priority = Laconic.EVENT_PRIO_MIN
         elif priority > Laconic.EVENT_PRIO_MAX:
             priority = Laconic.EVENT_PRIO_MAX
 
         self.event_hooks[event].add(priority, hook)
+        if methods is not None:
+            self._hook_methods[event, hook] = frozenset(methods)
+        self._frozen_hooks = None
 
-    def trigger_event(self, event, *args):
-        """Trigger an event and call all the hooks defined for it"""
+    def remove_event_hook(self, event, hook):
+        """Remove a previously added event hook for a specific event"""
         if event not in Laconic.POSSIBLE_EVENTS:
-            raise KeyError('Unknown event type `%s`, cannot trigger it' % event)
+            raise KeyError('Unknown event type `%s`, cannot remove a hook '
+                           'for it' % event)
 
-        for hook in self.event_hooks[event]:
-            hook(*args)
+        self.event_hooks[event].remove(hook)
+        self._hook_methods.pop((event, hook), None)
+        self._frozen_hooks = None
+
+    def trigger_event(self, event, *args, method=None):
+        """
+        Trigger an event and call all the hooks defined for it - when the
+        request `method` is given, also the hooks specific to that method
+
+        Coroutine hooks can only be run by `trigger_event_async`, under ASGI.
+        """
+        if self._frozen_hooks is None:
+            self._finalize_hooks()
+
+        hooks = self._frozen_hooks.get((event, method)) if method else None
+        if hooks is None:
+            hooks = self._frozen_hooks.get(event)
+            if hooks is None:
+                if event not in Laconic.POSSIBLE_EVENTS:
+                    raise KeyError('Unknown event type `%s`, cannot trigger it'
+                                   % event)
+                return
+
+        for hook in hooks:
+            result = hook(*args)
+            if inspect.isawaitable(result):
+                if inspect.iscoroutine(result):
+                    result.close()
+                raise TypeError('Event hook `%s` for event `%s` is a '
+                                'coroutine, which can only be run by an ASGI '
+                                'app' % (getattr(hook, '__name__', hook), event))
+
+    async def trigger_event_async(self, event, *args, method=None):
+        """
+        Trigger an event and call all the hooks defined for it (and the
+        request `method`), awaiting the ones which are coroutines
+        """
+        if self._frozen_hooks is None:
+            self._finalize_hooks()
+
+        hooks = self._frozen_hooks.get((event, method)) if method else None
+        if hooks is None:
+            hooks = self._frozen_hooks.get(event)
+            if hooks is None:
+                if event not in Laconic.POSSIBLE_EVENTS:
+                    raise KeyError('Unknown event type `%s`, cannot trigger it'
+                                   % event)
+                return
+
+        for hook in hooks:
+            result = hook(*args)
+            if inspect.isawaitable(result):
+                await result
 
     # Decorators
 
@@ -145,12 +240,12 @@ class Laconic:
             return _decorated
         return _decorator
 
-    def event_hook(self, event, priority=1):
+    def event_hook(self, event, priority=1, methods=None):
         """
         Decorator for defining event hooks, shortcut to `app.add_event_hook`
         """
         def _decorator(func):
-            self.add_event_hook(event, func, priority)
+            self.add_event_hook(event, func, priority, methods)
 
             @functools.wraps(func)
             def _decorated(*args, **kwargs):
@@ -166,7 +261,7 @@ class Laconic:
         """
         logger = logging.getLogger(self.name)
 
-        if self.config['DEBUG']:
+        if self._debug:
             logger.setLevel(logging.DEBUG)
             formatter = logging.Formatter('[%(asctime)s] '
                                           '<%(module)s/%(funcName)s '
@@ -182,22 +277,76 @@ class Laconic:
         logger.addHandler(handler)
         return logger
 
+    def _finalize_hooks(self):
+        """
+        Sort the event hooks once all of them are registered, and store the
+        tuples of hooks to call for each event - one for requests of any
+        method, and one for each method having method-specific hooks (whose
+        methods are kept in `_hook_methods`, by event and hook)
+        """
+        self._frozen_hooks = {}
+        for event, event_hooks in self.event_hooks.items():
+            hooks = [(hook, self._hook_methods.get((event, hook)))
+                     for hook in event_hooks]
+            self._frozen_hooks[event] = tuple(hook for hook, methods in hooks
+                                              if methods is None)
+            for method in {m for _, methods in hooks if methods for m in methods}:
+                self._frozen_hooks[event, method] = tuple(
+                    hook for hook, methods in hooks
+                    if methods is None or method in methods)
+
+    def _trigger_app_created(self):
+        """
+        Trigger the `on_app_created` event, unless it has already been
+        successfully triggered - if one of its hooks fails, the event is
+        triggered again on the next request
+        """
+        with self._app_created_lock:
+            if not self._app_created_triggered:
+                self.trigger_event('on_app_created')
+                self._app_created_triggered = True
+
+    async def _trigger_app_created_async(self):
+        """
+        Trigger the `on_app_created` event from within an event loop, see
+        `_trigger_app_created`
+        """
+        if self._app_created_async_lock is None:
+            self._app_created_async_lock = asyncio.Lock()
+
+        async with self._app_created_async_lock:
+            if not self._app_created_triggered:
+                await self.trigger_event_async('on_app_created')
+                self._app_created_triggered = True
+
+    def _find_exception_handler(self, exc_type):
+        """
+        Return the exception handler registered for the closest class in the
+        MRO of `exc_type`, or None if there is no such handler
+        """
+        exc_handler = self._exc_handler_cache.get(exc_type, _missing)
+        if exc_handler is _missing:
+            for base in exc_type.__mro__:
+                exc_handler = self._exc_handlers_by_type.get(base)
+                if exc_handler is not None:
+                    break
+            self._exc_handler_cache[exc_type] = exc_handler
+        return exc_handler
+
     def _process_http_options(self, endpoint, request, context):
         """
         Process HTTP OPTIONS requests, via event hooks
         """
-        if request.method != 'OPTIONS':
-            return
-
-        available_methods = self.router.get_available_methods(context.request.path)
-        make_context_response(context, '', headers=[('Allow', ','.join(available_methods))])
+        make_context_response(context, '', headers=[
+            ('Allow', self.router.get_allow_header(context.request.path))])
         context.state = Context.RESPONSE_GENERATED
 
-    # WSGI protocol
+    # WSGI & ASGI protocols
 
     def __call__(self, environ, start_response):
         """
-        A shortcut for accessing the WSGI application
+        A shortcut for accessing the WSGI application - ASGI servers should
+        be pointed at `app.asgi` instead
         """
         return self.application(environ, start_response)
 
@@ -205,23 +354,66 @@ class Laconic:
         """
         A WSGI application callable
         """
-
-        self.logger.info('Application object created, WSGI app started')
-        self.trigger_event('on_app_created')
-        self.logger.info('Started request handling')
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Started request handling')
 
         try:
+            if not self._app_created_triggered:
+                self._trigger_app_created()
+
             with Context(self, environ) as context:
-                for _ in context.do_next():
-                    pass
+                context.run()
             return context.response(environ, start_response)
         except Exception as exc:
             self.logger.error(exc)
             return (APIInternalServerError(
                     'An unexpected internal server error occured')
-                    .as_response(verbose=self.config['DEBUG'])
+                    .as_response(verbose=self._debug)
                     (environ, start_response))
 
+    async def asgi(self, scope, receive, send):
+        """
+        An ASGI (version 3) application callable, e.g. to run the app on
+        uvicorn as `uvicorn module:app.asgi`
+        """
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    try:
+                        await self._trigger_app_created_async()
+                    except Exception as exc:
+                        self.logger.error(exc)
+                        await send({'type': 'lifespan.startup.failed',
+                                    'message': str(exc)})
+                        return
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type `%s`' % scope['type'])
+
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Started request handling')
+
+        environ = make_wsgi_environ(scope, await read_asgi_body(receive))
+        try:
+            if not self._app_created_triggered:
+                await self._trigger_app_created_async()
+
+            async with AsyncContext(self, environ) as context:
+                await context.run()
+            response = context.response
+        except Exception as exc:
+            self.logger.error(exc)
+            response = (APIInternalServerError(
+                        'An unexpected internal server error occured')
+                        .as_response(verbose=self._debug))
+
+        await send_asgi_response(response, environ, send)
+
     # Builtin development WSGI server -werkzeug
 
     def run(self, host='localhost', port=8080):
@@ -6,7 +6,7 @@ Copyright:  (c) Zvonimir Jurelinac 2017
 License:    MIT, see LICENSE for more details
 """
 
-import traceback
+import inspect
 
 from werkzeug.datastructures import Headers
 
@@ -16,6 +16,25 @@ from .exceptions import BaseAPIException, APIContextProcessingError, \
 from .utilities import _missing, Request, make_context_response
 
 
+# Endpoint and exception handler parameter kinds, determined once when the
+# endpoint or handler is defined
+
+PARAM_PATH = 1          # URL path parameter
+PARAM_QUERY = 2         # Request parameter (query string, body, cookies)
+PARAM_HEADERS = 3       # Request headers
+PARAM_CONTEXT = 4       # Request handling context
+PARAM_EXCEPTION = 5     # Exception being handled
+PARAM_UNKNOWN = 0       # Exception handler parameter of unknown type
+
+# Effects yielded by the request-handling steps, as (kind, target, args,
+# kwargs) tuples - the target is an event name, an endpoint or an exception
+# handler
+
+_EFFECT_EVENT = 1
+_EFFECT_ENDPOINT = 2
+_EFFECT_HANDLER = 3
+
+
 class Context:
     """
     Request handling context, contains the state and all necessary data for
@@ -30,12 +49,8 @@ class Context:
     CONTEXT_FINALIZED = 6
     CONTEXT_ERROR = -1
 
-    _actions = {
-        CONTEXT_INITIALIZED: '_process_request',
-        REQUEST_PARSED: '_determine_endpoint',
-        ENDPOINT_DETERMINED: '_dispatch_request',
-        CONTEXT_ERROR: '_process_error'
-    }
+    __slots__ = ('state', '_app', 'environ', 'request', 'endpoint',
+                 'url_params', 'response', 'response_status', 'exception')
 
     def __init__(self, app, environ):
         self.state = Context.CONTEXT_CREATED
@@ -45,6 +60,7 @@ class Context:
         self.environ = environ
         self.request = None
         self.endpoint = None
+        self.url_params = None
         self.response = None
         self.response_status = None
         self.exception = None
@@ -53,30 +69,24 @@ class Context:
 
     def __enter__(self):
         """Initialize request context"""
-        self._init_context()
+        self._perform(self._init_context())
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Finalize request context"""
         if exc_type is not None:
-            print('An exception in context exit')
-            self.state = Context.CONTEXT_ERROR
-            self.exception = BaseAPIException.from_exception_data(
-                exc_type, exc_val, exc_tb)
-            self._app.logger.error(self.exception)
-            if self._app.config['DEBUG']:
-                self._app.logger.error('\n'.join(traceback.format_tb(exc_tb)))
+            self._record_exception(exc_type, exc_val, exc_tb)
 
-            self._process_error()
+            self._perform(self._process_error())
 
-        self._finalize_context()
+        self._perform(self._finalize_context())
         return True
 
     # Public methods for the app to call
 
-    def do_next(self):
+    def run(self):
         """
-        Perform the next step in request handling
+        Perform all the steps in request handling
 
         The steps are as follows:
             (0. Create request context  - in __init__)
@@ -86,23 +96,87 @@ class Context:
             4. Dispatch request
             5. Generate response
             (6. Finalize context         - in __exit__)
+
+        An event hook can generate the response itself, in which case the
+        remaining steps are skipped.
         """
-        while self.state != Context.RESPONSE_GENERATED:
-            handler = getattr(self, self._actions[self.state])
-            # self._app.logger.info('Doing %s' % handler.__name__)
-            yield handler()
+        self._perform(self._run_steps())
 
-    # Internal request-handling methods
+    def do_next(self):
+        """
+        Perform all the steps in request handling, as a generator
 
-    def _init_context(self):
+        Kept for compatibility with code driving the context step by step,
+        runs the whole pipeline via `run` and yields only once.
         """
-        Initialize the request context by calling `oncontextinit` handlers
+        self.run()
+        yield
+
+    # Step execution
+
+    def _perform(self, step):
+        """
+        Execute a request-handling `step`, performing the effects it yields
+        (event triggers and endpoint or exception handler calls) synchronously
         """
-        if self.state != Context.CONTEXT_CREATED:
+        value, error = None, None
+        while True:
+            try:
+                effect = step.send(value) if error is None else step.throw(error)
+            except StopIteration:
+                return
+
+            value, error = None, None
+            try:
+                value = self._perform_effect(*effect)
+            except Exception as exc:
+                error = exc
+
+    def _perform_effect(self, kind, target, args, kwargs):
+        """Perform a single effect yielded by a request-handling step"""
+        if kind == _EFFECT_EVENT:
+            return self._app.trigger_event(target, *args, **kwargs)
+        return target(*args, **kwargs)
+
+    # Internal request-handling steps - generators yielding the effects to
+    # perform, so the same steps serve both the WSGI and the ASGI interface
+
+    def _run_steps(self):
+        """Perform the request-handling steps which `run` consists of"""
+        yield from self._process_request()
+        if self.state == Context.REQUEST_PARSED:
+            yield from self._determine_endpoint()
+        if self.state == Context.ENDPOINT_DETERMINED:
+            yield from self._dispatch_request()
+        if self.state == Context.CONTEXT_ERROR:
+            yield from self._process_error()
+
+    def _record_exception(self, exc_type, exc_val, exc_tb):
+        """
+        Put the context into the error state, and log the exception which
+        escaped the request handling
+        """
+        self.state = Context.CONTEXT_ERROR
+        self.exception = BaseAPIException.from_exception_data(
+            exc_type, exc_val, exc_tb)
+        # The traceback is only formatted if the record is actually emitted
+        self._app.logger.error(
+            self.exception,
+            exc_info=(exc_type, exc_val, exc_tb) if self._app._debug else None)
+
+    def _check_state(self, state):
+        """Raise an exception if the context isn't in the expected `state`"""
+        if self.state != state:
             raise APIContextProcessingError('Didn\'t expect the context to be '
                                             'in state %d.' % self.state)
 
-        self._app.trigger_event('on_context_init', self)
+    def _init_context(self):
+        """
+        Initialize the request context by calling `oncontextinit` handlers
+        """
+        self._check_state(Context.CONTEXT_CREATED)
+
+        yield _event('on_context_init', self)
         self.state = Context.CONTEXT_INITIALIZED
 
     def _process_request(self):
@@ -110,60 +184,54 @@ class Context:
         Parse the incoming request into the `Request` wrapper and
         call `onrequestparsed` handlers
         """
-        if self.state != Context.CONTEXT_INITIALIZED:
-            raise APIContextProcessingError(
-                'Didn\'t expect the context to be in state %d.' % self.state)
+        self._check_state(Context.CONTEXT_INITIALIZED)
 
         self.request = Request(self.environ)
         self.state = Context.REQUEST_PARSED
-        self._app.trigger_event('on_request_parsed', self.request, self)
+        yield _event('on_request_parsed', self.request, self,
+                     method=self.request.method)
 
     def _determine_endpoint(self):
         """
         Determine which endpoint is responsible for serving the request and
         call `onendpointdetermined` handlers
         """
-        if self.state != Context.REQUEST_PARSED:
-            raise APIContextProcessingError('Didn\'t expect the context to be '
-                                            'in state %d.' % self.state)
+        self._check_state(Context.REQUEST_PARSED)
 
-        self.endpoint = self._app.router.determine_endpoint(self.request.path,
-                                                            self.request.method)
+        self.endpoint, self.url_params = self._app.router.match_endpoint(
+            self.request.path, self.request.method)
         self.state = Context.ENDPOINT_DETERMINED
-        self._app.trigger_event('on_endpoint_determined', self.endpoint,
-                                self.request, self)
+        yield _event('on_endpoint_determined', self.endpoint, self.request,
+                     self, method=self.request.method)
 
     def _dispatch_request(self):
         """
         Dispatch the request to the responsible endpoint, collect the response
         and call `onrequestdispatched` handlers
         """
-        if self.state != Context.ENDPOINT_DETERMINED:
-            raise APIContextProcessingError('Didn\'t expect the context to be '
-                                            'in state %d.' % self.state)
+        self._check_state(Context.ENDPOINT_DETERMINED)
 
-        endpoint_params = _select_endpoint_params(
-            self.endpoint, self, self.endpoint.get_url_params(self.request.path))
+        endpoint_params = _select_endpoint_params(self.endpoint, self,
+                                                  self.url_params)
 
         try:
-            make_context_response(self, self.endpoint(**endpoint_params))
+            response = yield (_EFFECT_ENDPOINT, self.endpoint, (),
+                              endpoint_params)
+            make_context_response(self, response)
             self.state = Context.RESPONSE_GENERATED
-            self._app.trigger_event('on_response_generated', self.response, self)
+            yield _event('on_response_generated', self.response, self,
+                         method=self.request.method)
         except Exception as exc:
-            exc_handler = None
-
-            for handler in self._app.exception_handlers:
-                if isinstance(exc, handler.exc_type):
-                    exc_handler = handler
-                    break
-
+            exc_handler = self._app._find_exception_handler(type(exc))
             if exc_handler is not None:
                 handler_params = _select_handler_params(exc_handler, self, exc)
-                result = (exc_handler(**handler_params) if handler_params
-                          else exc_handler(exc, self))
+                result = yield ((_EFFECT_HANDLER, exc_handler, (), handler_params)
+                                if handler_params else
+                                (_EFFECT_HANDLER, exc_handler, (exc, self), {}))
                 make_context_response(self, result)
                 self.state = Context.RESPONSE_GENERATED
-                self._app.trigger_event('on_response_generated', self)
+                yield _event('on_response_generated', self,
+                             method=self.request.method)
             else:
                 self.exception = APIEndpointRuntimeError.from_exception(exc)
                 self.state = Context.CONTEXT_ERROR
@@ -173,54 +241,161 @@ class Context:
         Generate a response from the exception that has occurred during
         processing of the current request
         """
-        if self.state != Context.CONTEXT_ERROR:
-            raise APIContextProcessingError('Didn\'t expect the context to be '
-                                            'in state %d.' % self.state)
+        self._check_state(Context.CONTEXT_ERROR)
 
         resp_generator = getattr(self.exception, 'as_response')
-        self.response = resp_generator(verbose=self._app.config['DEBUG'])
+        self.response = resp_generator(verbose=self._app._debug)
         self.state = Context.RESPONSE_GENERATED
-        self._app.trigger_event('on_response_generated', self.response, self)
+        yield _event('on_response_generated', self.response, self,
+                     method=self._request_method())
+
+    def _request_method(self):
+        """Return the HTTP method of the request, if it has been parsed"""
+        return self.request.method if self.request is not None else None
 
     def _finalize_context(self):
         """
         Destroy request context (close all used resources) by calling
         'oncontextdestroy' handlers
         """
-        if self.state != Context.RESPONSE_GENERATED:
-            raise APIContextProcessingError('Didn\'t expect the context to be '
-                                            'in state %d.' % self.state)
+        self._check_state(Context.RESPONSE_GENERATED)
 
-        self._app.trigger_event('on_context_finalize', self)
+        yield _event('on_context_finalize', self,
+                     method=self._request_method())
         self.state = Context.CONTEXT_FINALIZED
 
 
+class AsyncContext(Context):
+    """
+    Asynchronous request handling context, used by the ASGI interface - runs
+    the same steps as `Context`, but awaits the endpoints, exception handlers
+    and event hooks which are coroutines.
+    """
+
+    __slots__ = ()
+
+    # Asynchronous context manager methods
+
+    async def __aenter__(self):
+        """Initialize request context"""
+        await self._perform_async(self._init_context())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Finalize request context"""
+        if exc_type is not None:
+            self._record_exception(exc_type, exc_val, exc_tb)
+
+            await self._perform_async(self._process_error())
+
+        await self._perform_async(self._finalize_context())
+        return True
+
+    # Public methods for the app to call
+
+    async def run(self):
+        """
+        Perform all the steps in request handling, in the same order as
+        `Context.run`
+        """
+        await self._perform_async(self._run_steps())
+
+    async def do_next(self):
+        """
+        Perform all the steps in request handling, as an asynchronous
+        generator - see `Context.do_next`
+        """
+        await self.run()
+        yield
+
+    # Step execution
+
+    async def _perform_async(self, step):
+        """
+        Execute a request-handling `step`, awaiting the effects it yields
+        which are coroutines
+        """
+        value, error = None, None
+        while True:
+            try:
+                effect = step.send(value) if error is None else step.throw(error)
+            except StopIteration:
+                return
+
+            value, error = None, None
+            try:
+                value = await self._perform_effect_async(*effect)
+            except Exception as exc:
+                error = exc
+
+    async def _perform_effect_async(self, kind, target, args, kwargs):
+        """Perform a single effect yielded by a request-handling step"""
+        if kind == _EFFECT_EVENT:
+            return await self._app.trigger_event_async(target, *args, **kwargs)
+        elif kind == _EFFECT_ENDPOINT:
+            return await target.call_async(*args, **kwargs)
+
+        result = target(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
+def _event(event, *args, method=None):
+    """Return the effect of triggering an `event` with the hook `args`"""
+    return _EFFECT_EVENT, event, args, {'method': method}
+
+
+def endpoint_param_kind(param):
+    """Determine the kind of an endpoint parameter from its type and location"""
+    if isinstance(param.type_, type):
+        if issubclass(param.type_, Headers):
+            return PARAM_HEADERS
+        elif issubclass(param.type_, Context):
+            return PARAM_CONTEXT
+    return PARAM_PATH if param.location == 'path' else PARAM_QUERY
+
+
+def handler_param_kind(param):
+    """Determine the kind of an exception handler parameter from its type"""
+    if isinstance(param.type_, type):
+        if issubclass(param.type_, Exception):
+            return PARAM_EXCEPTION
+        elif issubclass(param.type_, Context):
+            return PARAM_CONTEXT
+    return PARAM_UNKNOWN
+
+
 def _select_endpoint_params(endpoint, context, url_params):
     """Return dictionary of all parameter values for the endpoint"""
     params_dict = {}
     for param in endpoint.parameters.values():
+        kind = param.kind
+        if kind == PARAM_PATH:
+            value = url_params[param.name]
+        elif kind == PARAM_QUERY:
+            value = context.request.param[param.name]
         # Special types
-        if issubclass(param.type_, Headers):
+        elif kind == PARAM_HEADERS:
             params_dict[param.name] = context.request.headers
-        elif issubclass(param.type_, Context):
+            continue
+        else:
             params_dict[param.name] = context
+            continue
 
-        else:
-            value = (url_params[param.name] if param.location == 'path' else
-                     context.request.param[param.name])
-            if value is None:
-                if param.default is not _missing:
-                    value = param.default
-                else:
-                    raise APIMissingParameterError(
-                        'Required parameter `%s` is missing from the request'
-                        % param.name)
+        if value is None:
+            if param.default is not _missing:
+                value = param.default
+            else:
+                raise APIMissingParameterError(
+                    'Required parameter `%s` is missing from the request'
+                    % param.name)
 
-            try:
-                params_dict[param.name] = param.type_(value)
-            except Exception as exc:
-                raise APIInvalidParameterError(
-                    'Request parameter `%s` is invalid: %s' % (param.name, exc))
+        try:
+            params_dict[param.name] = param.type_(value)
+        except Exception as exc:
+            raise APIInvalidParameterError(
+                'Request parameter `%s` is invalid: %s' % (param.name, exc))
 
     return params_dict
 
@@ -229,9 +404,9 @@ def _select_handler_params(handler, context, exception):
     """Return dictionary of all parameter values for an exception handler"""
     params_dict = {}
     for param in handler.parameters.values():
-        if issubclass(param.type_, Exception):
+        if param.kind == PARAM_EXCEPTION:
             params_dict[param.name] = exception
-        elif issubclass(param.type_, Context):
+        elif param.kind == PARAM_CONTEXT:
             params_dict[param.name] = context
         else:
             # raise KeyError('Unknown exception handler parameter type: %s' % param.type_)
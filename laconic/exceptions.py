@@ -7,12 +7,23 @@ Copyright:  (c) Zvonimir Jurelinac 2017
 License:    MIT, see LICENSE for more details
 """
 
+from weakref import WeakValueDictionary
+
 from werkzeug.exceptions import HTTPException
 from werkzeug.http import HTTP_STATUS_CODES
 
 from .utilities import Response, make_json, make_exception_name
 
 
+# HTTP status lines by status code (ex. 400: '400 Bad Request')
+STATUS_STRINGS = {code: '%d %s' % (code, reason)
+                  for code, reason in HTTP_STATUS_CODES.items()}
+
+# API exception classes generated from other exception classes, by
+# (API exception baseclass, original exception class)
+_api_exception_types = WeakValueDictionary()
+
+
 class BaseAPIException(Exception):
     """Baseclass for all East framework exceptions.
 
@@ -56,7 +67,7 @@ class BaseAPIException(Exception):
     @property
     def status(self):
         """Exception HTTP status - ### Reason (ex. 400 Bad Request)"""
-        return '%s %s' % (self.status_code, HTTP_STATUS_CODES[self.status_code])
+        return STATUS_STRINGS[self.status_code]
 
     @classmethod
     def from_exception(cls, exception):
@@ -73,9 +84,8 @@ class BaseAPIException(Exception):
         else:
             description = str(exception)
             status_code = 500
-        exc_type = type('API' + exception.__class__.__name__,
-                        (cls, exception.__class__), {})
-        exc = exc_type(description, status_code)
+        exc = cls._api_exception_type(exception.__class__)(description,
+                                                            status_code)
         exc.__traceback__ = exception.__traceback__
         return exc
 
@@ -95,11 +105,20 @@ class BaseAPIException(Exception):
                 description = str(exc_val)
                 status_code = 500
 
-            new_exc_type = type('API' + exc_type.__name__, (cls, exc_type), {})
-            new_exc = new_exc_type(description, status_code)
+            new_exc = cls._api_exception_type(exc_type)(description, status_code)
             new_exc.__traceback__ = exc_tb
             return new_exc
 
+    @classmethod
+    def _api_exception_type(cls, exc_type):
+        """Return an exception class derived from both this class and
+        `exc_type`, creating it only the first time it is needed"""
+        api_exc_type = _api_exception_types.get((cls, exc_type))
+        if api_exc_type is None:
+            api_exc_type = type('API' + exc_type.__name__, (cls, exc_type), {})
+            _api_exception_types[cls, exc_type] = api_exc_type
+        return api_exc_type
+
     def __str__(self):
         code = self.status_code if self.status_code is not None else '???'
         return '<%s %s>: %s' % (code, self.name, self.description)
@@ -124,13 +143,14 @@ class APIMethodNotAllowedError(BaseAPIException):
 
     def __init__(self, description, status_code=None, name=None, data=None,
                  valid_methods=None):
-        BaseAPIException.__init__(description, status_code, name, data)
+        BaseAPIException.__init__(self, description, status_code, name, data)
         self.valid_methods = valid_methods or []
+        self._allow_header = ', '.join(self.valid_methods)
 
     def as_response(self, verbose=False):
         return Response(self.as_json(verbose), status=self.status_code,
                         content_type='application/json',
-                        headers=[('Allow', ', '.join(self.valid_methods))])
+                        headers=[('Allow', self._allow_header)])
 
 
 class APIDoesNotExistError(BaseAPIException):
@@ -6,46 +6,119 @@ Copyright:  (c) Zvonimir Jurelinac 2017
 License:    MIT, see LICENSE for more details
 """
 
+import asyncio
+import functools
 import inspect
 import re
+import sys
+from types import MappingProxyType
 
+from .context import endpoint_param_kind, handler_param_kind
 from .exceptions import APIEndpointNotFoundError, APIMethodNotAllowedError, \
     APIEndpointDefinitionError
-from .utilities import AttributeScope, _missing, exc_type_compare
+from .utilities import AttributeScope, _missing, exc_type_rank
+
+
+_NO_URL_PARAMS = MappingProxyType({})
 
 
 class Router:
     """
     Request to endpoint router class - determines which endpoint should be
     called for a particular request
+
+    Static URL rules (ones without any URL parameters) are indexed by their
+    URL path in a dict. URL rules whose parameters each span a whole URL path
+    segment are stored in a segment trie, so finding an endpoint costs a dict
+    lookup per path segment; the remaining rules are joined into a single
+    alternation regex, matched once per request.
+
+    Matching endpoints and available HTTP methods of the most recently
+    requested non-static URL paths are cached, up to `cache_size` of them.
     """
 
-    def __init__(self):
+    def __init__(self, cache_size=1024):
         self.endpoints = []
+        self.cache_size = cache_size
+        self._static_endpoints = {}
+        self._trie = TrieNode()
+        # Registration order of the endpoints stored in the trie
+        self._trie_indices = {}
+        # Rules matched by regex, kept as parallel lists of their endpoints,
+        # regex matchers, HTTP method sets and registration order
+        self._regex_endpoints = []
+        self._regex_matchers = []
+        self._regex_methods = []
+        self._regex_indices = []
+        self._regex_dispatch = None
+        self._match_cache = functools.lru_cache(maxsize=cache_size)(
+            self._match_path)
 
     def add_rule(self, url_rule, endpoint, methods=None, attrs=None):
         """Add an endpoint with a given `url_rule` and a set of `attrs`."""
-        self.endpoints.append(Endpoint(url_rule, endpoint, methods, attrs))
+        endpoint = Endpoint(url_rule, endpoint, methods, attrs)
+        self.endpoints.append(endpoint)
+        if endpoint.url_rule.static:
+            static_endpoints = self._static_endpoints.setdefault(
+                sys.intern(endpoint.url_rule.literal), {})
+            for method in endpoint.methods:
+                static_endpoints.setdefault(method, endpoint)
+        elif endpoint.url_rule.segments is not None:
+            self._trie.insert(endpoint.url_rule.segments, endpoint)
+            self._trie_indices[endpoint] = len(self.endpoints)
+        else:
+            self._regex_endpoints.append(endpoint)
+            self._regex_matchers.append(endpoint.url_rule.regex.match)
+            self._regex_methods.append(endpoint.methods)
+            self._regex_indices.append(len(self.endpoints))
+            self._regex_dispatch = None
+
+        self._match_cache.cache_clear()
 
     def determine_endpoint(self, url_path, method):
         """
         Return the matching endpoint for a given `url_path`, or raise an
         exception if none is found (or the requested HTTP method is
         unsupported for that endpoint).
+
+        Static rules take precedence over the ones with URL parameters, and
+        among the trie-stored rules, the ones with a literal segment over the
+        ones with a URL parameter in its place. Otherwise the first registered
+        matching rule wins.
+        """
+        return self.match_endpoint(url_path, method)[0]
+
+    def match_endpoint(self, url_path, method):
         """
-        available_methods = set()
-        for endpoint in self.endpoints:
-            match, method_match = endpoint.match(url_path, method)
-            if match and method_match:
-                return endpoint
-            elif match:
-                available_methods.update(endpoint.methods)
+        Return the matching endpoint for a given `url_path` together with the
+        URL parameters extracted from it while matching, or raise an exception
+        like `determine_endpoint`
 
+        The URL parameters are a read-only mapping, shared between the
+        requests for the same URL path.
+        """
+        static_endpoints = self._static_endpoints.get(url_path)
+        if static_endpoints is not None:
+            endpoint = static_endpoints.get(method)
+            if endpoint is not None:
+                return endpoint, _NO_URL_PARAMS
+
+        endpoints, available_methods, _ = self._match_cache(url_path)
+        match = endpoints.get(method)
+        if match is None:
+            self._raise_no_match(url_path, method, available_methods)
+        return match
+
+    def _raise_no_match(self, url_path, method, available_methods):
+        """
+        Raise the appropriate exception for a `url_path` and `method` which
+        no endpoint can serve
+        """
         if len(available_methods) > 0:
             raise APIMethodNotAllowedError(
                 'HTTP method `%s` is not allowed for this endpoint, perhaps try '
                 '[%s]?' % (method, ', '.join(available_methods)),
-                valid_methods=available_methods)
+                valid_methods=list(available_methods))
         else:
             raise APIEndpointNotFoundError('There is no endpoint defined for '
                                            'the `%s` URL path.' % url_path)
@@ -54,13 +127,164 @@ class Router:
         """
         Return a list of available HTTP methods registered for a given URL
         """
-        available_methods = set()
-        for endpoint in self.endpoints:
-            match, _ = endpoint.match(url_path)
-            if match:
-                available_methods.update(endpoint.methods)
+        return list(self._match_cache(url_path)[1])
 
-        return list(available_methods)
+    def get_allow_header(self, url_path):
+        """
+        Return the `Allow` HTTP header value (comma-separated available HTTP
+        methods) for a given URL
+        """
+        return self._match_cache(url_path)[2]
+
+    def _match_path(self, url_path):
+        """
+        Match a given URL against all the rules in a single pass, and return
+        the matching endpoints (by HTTP method, each being the one with the
+        highest precedence, paired with its URL parameters), a tuple of the
+        available HTTP methods and the `Allow` header value listing them
+        """
+        endpoints = {method: (endpoint, _NO_URL_PARAMS) for method, endpoint
+                     in self._static_endpoints.get(url_path, {}).items()}
+
+        # Best matching trie-stored and regex-matched rules, by HTTP method
+        dynamic_endpoints = {}
+        segments = url_path.split('/')
+        for node in self._trie.find(segments):
+            for method, endpoint in node.endpoints.items():
+                if method not in endpoints and method not in dynamic_endpoints:
+                    dynamic_endpoints[method] = (
+                        self._trie_indices[endpoint], endpoint,
+                        MappingProxyType(
+                            endpoint.url_rule.segment_params(segments)))
+
+        if self._regex_endpoints:
+            if self._regex_dispatch is None:
+                self._regex_dispatch = _compile_dispatch_regex(
+                    self._regex_endpoints)
+
+            # The combined regex finds the first matching rule, or rules out
+            # all of them at once
+            match = self._regex_dispatch(url_path)
+            if match is not None:
+                regex_endpoints = self._regex_endpoints
+                regex_matchers = self._regex_matchers
+                regex_indices = self._regex_indices
+                regex_found = set()
+                for i in range(int(match.lastgroup[1:]), len(regex_endpoints)):
+                    match = regex_matchers[i](url_path)
+                    if match is None:
+                        continue
+
+                    url_params = MappingProxyType(match.groupdict())
+                    for method in self._regex_methods[i]:
+                        if method in endpoints or method in regex_found:
+                            continue
+                        regex_found.add(method)
+
+                        # A trie-stored rule only wins if registered earlier
+                        trie_match = dynamic_endpoints.get(method)
+                        if trie_match is None or \
+                                regex_indices[i] < trie_match[0]:
+                            dynamic_endpoints[method] = (
+                                regex_indices[i], regex_endpoints[i],
+                                url_params)
+
+        for method, (_, endpoint, url_params) in dynamic_endpoints.items():
+            endpoints[method] = (endpoint, url_params)
+
+        return endpoints, tuple(endpoints), ','.join(endpoints)
+
+
+def _compile_dispatch_regex(endpoints):
+    """
+    Join the URL rule regexes of `endpoints` into a single alternation regex
+    and return its `match` method - the name of the matched group, `r<index>`,
+    identifies the first matching endpoint
+
+    URL parameter groups are prefixed with the rule group name to keep them
+    unique across the rules.
+    """
+    alternatives = ('(?P<r%d>%s)' % (i, endpoint.url_rule.regex.pattern
+                                     .replace('(?P<', '(?P<r%d_' % i))
+                    for i, endpoint in enumerate(endpoints))
+    return re.compile('|'.join(alternatives)).match
+
+
+class TrieNode:
+    """
+    URL path segment trie node - contains the child nodes for literal path
+    segments and for typed URL parameters, and the endpoints (by HTTP method)
+    of the URL rules ending in this node
+    """
+
+    __slots__ = ('match', 'children', 'param_children', 'param_stack',
+                 'endpoints')
+
+    def __init__(self, match=None):
+        self.match = match
+        self.children = {}
+        self.param_children = {}
+        # Parameter children in the order they are pushed onto the lookup
+        # stack, so they are popped in the insertion order
+        self.param_stack = ()
+        self.endpoints = {}
+
+    def insert(self, segments, endpoint):
+        """
+        Add an endpoint for URL rule `segments` - a list of (None, literal)
+        and (param type, param name) pairs
+        """
+        node = self
+        for param_type, value in segments:
+            if param_type is None:
+                child = node.children.get(value)
+                if child is None:
+                    # Interned, as the literal segments are compared with
+                    # request path segments on every lookup
+                    child = node.children[sys.intern(value)] = TrieNode()
+            else:
+                child = node.param_children.get(param_type)
+                if child is None:
+                    child = node.param_children[param_type] = \
+                        TrieNode(URLRule.TYPE_MATCHERS[param_type])
+                    node.param_stack = (child,) + node.param_stack
+            node = child
+
+        for method in endpoint.methods:
+            node.endpoints.setdefault(method, endpoint)
+
+    def find(self, segments):
+        """
+        Yield all the nodes with endpoints in which the URL path `segments`
+        end, literal segment matches first
+
+        The trie is walked iteratively - parameter children are pushed onto a
+        stack while descending into a literal child, and only tried once the
+        literal branch reaches a dead end.
+        """
+        n_segments = len(segments)
+        node, i = self, 0
+        stack = []
+        push, pop = stack.append, stack.pop
+
+        while True:
+            if i < n_segments:
+                for child in node.param_stack:
+                    push((child, i))
+                child = node.children.get(segments[i])
+                if child is not None:
+                    node, i = child, i + 1
+                    continue
+            elif node.endpoints:
+                yield node
+
+            while stack:
+                node, i = pop()
+                if node.match(segments[i]):
+                    i += 1
+                    break
+            else:
+                return
 
 
 class Endpoint:
@@ -70,15 +294,23 @@ class Endpoint:
 
     def __init__(self, url_rule, endpoint, methods=None, attrs=None):
         self.name = endpoint.__name__
-        self.methods = methods
+        # A single method may be given as a plain string, e.g. 'GET'
+        if isinstance(methods, str):
+            methods = (methods,)
+        self.methods = frozenset(methods or ())
         self.endpoint = endpoint
+        self.is_coroutine = inspect.iscoroutinefunction(endpoint)
         self.url_rule = URLRule(url_rule)
         self.attrs = AttributeScope(attrs)
 
         signature = inspect.signature(endpoint)
+        path_params = frozenset(self.url_rule.url_params)
 
-        self.parameters = {k: EndpointParam.from_inspect(v, type_mandatory=True)
-                           for k, v in signature.parameters.items()}
+        self.parameters = {
+            k: EndpointParam.from_inspect(
+                v, type_mandatory=True,
+                location='path' if k in path_params else None)
+            for k, v in signature.parameters.items()}
         # TODO: What about the result, which conditions must it satisfy?
         # TODO: Pass special variables to the result wrapper
         self.result = EndpointResult(signature.return_annotation)
@@ -88,7 +320,9 @@ class Endpoint:
                 raise APIEndpointDefinitionError(
                     'Parameter `%s`, defined in the URL, is not present in '
                     'endpoint function signature.' % param)
-            self.parameters[param].location = 'path'
+
+        for param in self.parameters.values():
+            param.kind = endpoint_param_kind(param)
 
     def match(self, url_path, method=None):
         """Test if provided `url_path` matches this endpoint URL rule"""
@@ -101,27 +335,49 @@ class Endpoint:
     def __call__(self, *args, **kwargs):
         return self.result(self.endpoint(*args, **kwargs))
 
+    async def call_async(self, *args, **kwargs):
+        """
+        Call the endpoint from within an event loop - coroutine endpoints are
+        awaited, regular ones are run in the loop's default executor
+        """
+        if self.is_coroutine:
+            value = await self.endpoint(*args, **kwargs)
+        else:
+            value = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.endpoint, *args, **kwargs))
+        return self.result(value)
+
+
+_EMPTY = inspect.Signature.empty
+
 
 class FunctionParam:
     """
     Generic function parameter object - contains parameter name, type and
     default value (if any)
     """
+
+    __slots__ = ('name', 'type_', 'default', 'kind')
+
     def __init__(self, name, type_, default=_missing):
         self.name = name
         self.type_ = type_
         self.default = default
+        self.kind = None
 
     @classmethod
-    def from_inspect(cls, inspect_param, type_mandatory=False):
-        """Create an EndpointParam from the inspect.Parameter object"""
-        if type_mandatory and inspect_param.annotation is inspect.Signature.empty:
+    def from_inspect(cls, inspect_param, type_mandatory=False, **kwargs):
+        """
+        Create an EndpointParam from the inspect.Parameter object, passing
+        any extra `kwargs` (e.g. `location`) to the constructor
+        """
+        if type_mandatory and inspect_param.annotation is _EMPTY:
             raise APIEndpointDefinitionError('Type of parameter `%s` is '
                                              'undefined' % inspect_param.name)
 
+        default = inspect_param.default
         return cls(inspect_param.name, inspect_param.annotation,
-                   inspect_param.default if inspect_param.default
-                   is not inspect.Signature.empty else _missing)
+                   default if default is not _EMPTY else _missing, **kwargs)
 
 
 class EndpointParam(FunctionParam):
@@ -130,11 +386,12 @@ class EndpointParam(FunctionParam):
     default value and documentation.
     """
 
+    __slots__ = ('location',)
+
     def __init__(self, name, type_, default=_missing, location=None):
         super().__init__(name, type_, default)
         self.location = location
 
-
 class EndpointResult:
     """
     Endpoint result processor - contains a callable
@@ -154,12 +411,18 @@ class ExceptionHandler:
     exception type
     """
 
+    __slots__ = ('exc_type', 'handler', 'parameters', '_mro_set', '_rank')
+
     def __init__(self, exc_type, handler):
         self.exc_type = exc_type
         self.handler = handler
+        self._mro_set, self._rank = exc_type_rank(exc_type)
         self.parameters = {k: FunctionParam.from_inspect(v) for k, v
                            in inspect.signature(handler).parameters.items()}
 
+        for param in self.parameters.values():
+            param.kind = handler_param_kind(param)
+
     def __call__(self, *args, **kwargs):
         return self.handler(*args, **kwargs)
 
@@ -168,7 +431,12 @@ class ExceptionHandler:
                 (self.handler == other.handler))
 
     def __lt__(self, other):
-        return exc_type_compare(self.exc_type, other.exc_type) < 0
+        # Same as `exc_type_compare(self.exc_type, other.exc_type) < 0`
+        if other.exc_type in self._mro_set:
+            return True
+        elif self.exc_type in other._mro_set:
+            return False
+        return self._rank < other._rank
 
 
 class URLRule:
@@ -177,42 +445,109 @@ class URLRule:
     TYPE_REGEXES = {'int': r'\-?\d+', 'string': r'[^/]+',
                     'float': r'\-?\d+(\.\d*)?', 'path': r'[^/].?'}
 
-    _split_re = re.compile(r'(<|>|:)')
+    # Whole URL path segment matchers, returning a truthy value on a match -
+    # segments contain no slashes, so any non-empty one is a valid string
+    TYPE_MATCHERS = {name: re.compile(regex + r'\Z').match
+                     for name, regex in TYPE_REGEXES.items()}
+    TYPE_MATCHERS['string'] = bool
+
+    _segment_param_re = re.compile(r'<(\w+):(\w+)>')
 
     def __init__(self, url_rule):
-        self.url_params = []
-        regex = []
-        rule_tokens = self._split_re.split(url_rule)
-        i = 0
-        try:
-            while i < len(rule_tokens):
-                if rule_tokens[i] == '<':
-                    if (i + 4 >= len(rule_tokens) or rule_tokens[i + 2] != ':'
-                            or rule_tokens[i + 4] != '>'):
-                        raise ValueError('Malformed URL rule `%s`, missing a '
-                                         'part of param definition' % url_rule)
-                    regex.append('(?P<%s>%s)' %
-                                 (rule_tokens[i + 3],
-                                  self.TYPE_REGEXES[rule_tokens[i + 1]]))
-                    self.url_params.append(rule_tokens[i + 3])
-                    i += 5
-                elif rule_tokens[i] in ('>', ':'):
-                    raise ValueError('Unexpected character `%s` in the URL '
-                                     'rule `%s` ' % (rule_tokens[i], url_rule))
-                else:
-                    regex.append(re.escape(rule_tokens[i]))
-                    i += 1
-            self.regex = re.compile(''.join(regex))
-        except Exception as exc:
-            raise APIEndpointDefinitionError(str(exc))
+        self.regex, self.url_params, self.segments = _compile_url_rule(url_rule)
+        self._match = self.regex.match
+        self.static = not self.url_params
+        self.literal = url_rule if self.static else None
+        # Positions and names of the URL params in the rule's path segments
+        self._segment_params = tuple(
+            (i, name) for i, (param_type, name) in enumerate(self.segments)
+            if param_type is not None) if self.segments is not None else None
 
     def match(self, url_path):
         """Test if given `url_path` matches this URL rule"""
-        return self.regex.fullmatch(url_path) is not None
+        if self.static:
+            return url_path == self.literal
+        return self._match(url_path) is not None
 
     def extract_params(self, url_path):
         """Extract parameters from a given URL"""
-        return self.regex.fullmatch(url_path).groupdict()
+        if self.static:
+            return {}
+        return self._match(url_path).groupdict()
+
+    def segment_params(self, segments):
+        """
+        Extract parameters from the path segments of a URL which is already
+        known to match this (segment-aligned) URL rule
+        """
+        return {name: segments[i] for i, name in self._segment_params}
+
+
+# Scans a URL rule one token at a time - a param definition or a literal run
+_TOKEN_RE = re.compile(r'<(?P<type>\w+):(?P<name>\w+)>|(?P<lit>[^<>:]+)')
+
+# URL rule literals made only of these characters need no regex escaping
+_unescaped_literal_re = re.compile(r'[A-Za-z0-9/_-]+')
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_url_rule(url_rule):
+    """
+    Parse a URL rule and return its compiled regex, a tuple of its URL
+    parameter names and a tuple of its URL path segments - (None, literal) and
+    (param type, param name) pairs - or None if the rule has parameters which
+    don't span exactly one whole segment.
+
+    Results are memoized, so rules registered more than once share them.
+    """
+    url_params = []
+    regex = []
+    position = 0
+    for token in _TOKEN_RE.finditer(url_rule):
+        if token.start() != position:
+            break
+        position = token.end()
+
+        if token.lastgroup == 'lit':
+            literal = token.group('lit')
+            regex.append(literal if _unescaped_literal_re.fullmatch(literal)
+                         else re.escape(literal))
+            continue
+
+        param_type, param_name = token.group('type', 'name')
+        if param_type not in URLRule.TYPE_REGEXES:
+            raise APIEndpointDefinitionError(
+                'Unknown URL param type `%s` in the URL rule `%s`' %
+                (param_type, url_rule))
+        regex.append('(?P<%s>%s)' %
+                     (param_name, URLRule.TYPE_REGEXES[param_type]))
+        url_params.append(param_name)
+
+    if position != len(url_rule):
+        raise APIEndpointDefinitionError(
+            'Malformed URL rule `%s`, unexpected character `%s` at position %d'
+            % (url_rule, url_rule[position], position))
+
+    try:
+        # Anchored at the end, so the regex can be matched with `match`
+        compiled_regex = re.compile(''.join(regex) + r'\Z')
+    except re.error as exc:
+        raise APIEndpointDefinitionError(str(exc))
+
+    segments = []
+    for segment in url_rule.split('/'):
+        if '<' not in segment:
+            segments.append((None, segment))
+            continue
+
+        param = URLRule._segment_param_re.fullmatch(segment)
+        if param is None or param.group(1) == 'path':
+            segments = None
+            break
+        segments.append(param.groups())
+
+    return (compiled_regex, tuple(url_params),
+            tuple(segments) if segments is not None else None)
 
 
 class Region:
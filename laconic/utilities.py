@@ -8,19 +8,37 @@
 """
 
 import bisect
+import collections
+import collections.abc
+import functools
+import heapq
+import io
 import json
 import re
+import sys
+import weakref
 
 from werkzeug.wrappers import BaseRequest, AcceptMixin, ETagRequestMixin, \
     AuthorizationMixin, CommonRequestDescriptorsMixin, \
     BaseResponse, CommonResponseDescriptorsMixin, \
     ETagResponseMixin
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # Utility constants
 
 _missing = object()  # A sentinel value representing missing cache
 
+# JSON encoder and its options, shared by all the `make_json` calls
+_ORJSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS | \
+    orjson.OPT_NON_STR_KEYS if orjson is not None else None
+_json_encoder = json.JSONEncoder(indent=2, sort_keys=True,
+                                 separators=(',', ': '))
+
 
 # HTTP data structures
 
@@ -38,9 +56,14 @@ class Request(BaseRequest, CommonRequestDescriptorsMixin, ETagRequestMixin,
         Test if the request carries JSON data (by looking at the
         `Content-Type` HTTP header)
         """
-        return (self.mimetype == 'application/json') or \
-               (self.mimetype.startswith('application/') and
-                self.mimetype.endswith('+json'))
+        try:
+            return self._is_json
+        except AttributeError:
+            mimetype = self.mimetype
+            self._is_json = (mimetype == 'application/json') or \
+                            (mimetype.startswith('application/') and
+                             mimetype.endswith('+json'))
+            return self._is_json
 
     @property
     def json(self):
@@ -49,21 +72,20 @@ class Request(BaseRequest, CommonRequestDescriptorsMixin, ETagRequestMixin,
 
         If the request doesn't contain JSON data, it will return `None`.
         """
-
-        json_data = getattr(self, '_cached_json', _missing)
-        if json_data is not _missing:
-            return json_data
+        try:
+            return self._cached_json
+        except AttributeError:
+            pass
 
         request_charset = self.mimetype_params.get('charset')
         try:
             if request_charset is not None:
-                json_data = json.loads(self.get_data(as_text=True),
-                                       encoding=request_charset)
+                json_data = json.loads(self.get_data().decode(request_charset))
             else:
                 json_data = json.loads(self.get_data(as_text=True))
             self._cached_json = json_data
             return json_data
-        except ValueError:
+        except (ValueError, LookupError):
             pass
 
     @property
@@ -111,9 +133,18 @@ class AttributeScope:
         self.parent = parent
 
     def __getitem__(self, key):
-        if key in self.data:
-            return self.data
-        return self.parent[key] if self.parent is not None else None
+        return self.get(key)
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key` from the nearest scope containing it, or
+        `default` if none does
+        """
+        value = self.data.get(key, _missing)
+        if value is not _missing:
+            return value
+        return self.parent.get(key, default) if self.parent is not None \
+            else default
 
     def __setitem__(self, key, value):
         self.data[key] = value
@@ -121,32 +152,81 @@ class AttributeScope:
     def __delitem__(self, key):
         del self.data[key]
 
+    def __contains__(self, key):
+        return key in self.data or (self.parent is not None and
+                                    key in self.parent)
+
+    def __iter__(self):
+        yield from self.data
+        if self.parent is not None:
+            for key in self.parent:
+                if key not in self.data:
+                    yield key
+
 
 class SortedList:
     """
     A list of values sorted by their priority and insertion order.
-    Not too fast implementation as of yet.
+
+    Added values are pushed onto a heap, and the whole list is sorted only
+    once it is read (or explicitly finalized) after the additions. Sort keys
+    of the (hashable) values are indexed, so they can be removed by a binary
+    search.
     """
 
     def __init__(self):
         self.elems = []
         self.counter = 0
+        self.is_sorted = True
+        self._keys = {}
 
     def add(self, priority, value):
         """
-        Add an element to the sorted list, which remains sorted afterwards
+        Add an element to the sorted list, which gets sorted when next read
         """
-        bisect.insort(self.elems, (-priority, self.counter, value))
+        key = (-priority, self.counter)
+        heapq.heappush(self.elems, key + (value,))
         self.counter += 1
+        self.is_sorted = False
+
+        try:
+            self._keys.setdefault(value, []).append(key)
+        except TypeError:
+            pass
+
+    def finalize(self):
+        """Sort the elements added since the list was last sorted"""
+        if not self.is_sorted:
+            self.elems.sort()
+            self.is_sorted = True
 
     def remove(self, value):
         """Remove an element from the sorted list"""
-        for i, elem in enumerate(self.elems):
-            if elem[2] == value:
-                del self.elems[i]
-                break
+        self.finalize()
+        try:
+            keys = self._keys.get(value)
+        except TypeError:
+            for i, elem in enumerate(self.elems):
+                if elem[2] == value:
+                    del self.elems[i]
+                    break
+            return
+
+        if keys:
+            key = min(keys)
+            keys.remove(key)
+            if not keys:
+                del self._keys[value]
+            del self.elems[bisect.bisect_left(self.elems, key)]
+
+    def __contains__(self, value):
+        try:
+            return value in self._keys
+        except TypeError:
+            return any(elem[2] == value for elem in self.elems)
 
     def __iter__(self):
+        self.finalize()
         for elem in self.elems:
             yield elem[2]
 
@@ -159,12 +239,18 @@ class CombinedDict:
     """
 
     def __init__(self, dicts):
-        self.dicts = [d for d in dicts if d is not None]
+        self.dicts = [d for d in dicts
+                      if isinstance(d, collections.abc.Mapping)]
+        self._chain = collections.ChainMap(*self.dicts)
 
     def __getitem__(self, key):
-        for dct in self.dicts:
-            if key in dct:
-                return dct[key]
+        try:
+            return self._chain[key]
+        except KeyError:
+            return None
+
+    def __contains__(self, key):
+        return key in self._chain
 
     def __setitem__(self, key, value):
         raise TypeError('Cannot modify contents of a CombinedDict')
@@ -173,8 +259,18 @@ class CombinedDict:
 # Utility functions
 
 def make_json(data_dict):
-    """Return JSON representation of Python `data_dict` dictionary."""
-    return json.dumps(data_dict, indent=4, sort_keys=True, separators=(',', ': '))
+    """
+    Return JSON representation of Python `data_dict` dictionary.
+
+    Uses the `orjson` package for encoding if it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data_dict,
+                                option=_ORJSON_OPTIONS).decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass  # E.g. integers out of 64-bit range, left to the stdlib
+    return _json_encoder.encode(data_dict)
 
 
 def make_context_response(context, response_obj, headers=None):
@@ -198,24 +294,111 @@ def make_context_response(context, response_obj, headers=None):
                                         headers=headers)
 
 
+def make_wsgi_environ(scope, body):
+    """Construct a WSGI environ dictionary from an ASGI HTTP `scope` and the
+    complete request `body`"""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = \
+            scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ('; ' if name == 'HTTP_COOKIE' else ',') + value
+        environ[name] = value
+
+    # The body is already read in full, so its length is known even when the
+    # client didn't send it (chunked HTTP/1.1 or HTTP/2 requests)
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    return environ
+
+
+async def read_asgi_body(receive):
+    """Read the complete request body from an ASGI `receive` channel"""
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(body)
+
+
+async def send_asgi_response(response, environ, send):
+    """Send a WSGI `response` object through an ASGI `send` channel"""
+    app_iter, status, headers = response.get_wsgi_response(environ)
+    await send({'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                            for k, v in headers]})
+    try:
+        for chunk in app_iter:
+            await send({'type': 'http.response.body', 'body': chunk,
+                        'more_body': True})
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    await send({'type': 'http.response.body', 'body': b''})
+
+
 def make_exception_name(exception):
     """Convert an exception class name to a human-readable name"""
-    return ' '.join(filter(lambda x: x not in ('API', 'Exception') and x,
-                           re.split(r'((?<=[a-zA-Z])[A-Z][a-z]+)',
-                                    exception.__class__.__name__)))
+    exc_type = type(exception)
+    try:
+        return _exception_type_names[exc_type]
+    except KeyError:
+        name = _exception_type_names[exc_type] = ' '.join(
+            word for word in _camel_case_word_re.split(exc_type.__name__)
+            if word and word not in ('API', 'Exception'))
+        return name
+
+
+_camel_case_word_re = re.compile(r'((?<=[a-zA-Z])[A-Z][a-z]+)')
+
+# Human-readable exception names, by exception type - weakly keyed, so that
+# dynamically created exception types can still be garbage collected
+_exception_type_names = weakref.WeakKeyDictionary()
 
 
 def exc_type_compare(exc_type1, exc_type2):
     """Compare two exception types"""
-    if issubclass(exc_type1, exc_type2):
+    mro_set1, rank1 = exc_type_rank(exc_type1)
+    mro_set2, rank2 = exc_type_rank(exc_type2)
+
+    if exc_type2 in mro_set1:
         return -1
-    elif issubclass(exc_type2, exc_type1):
+    elif exc_type1 in mro_set2:
         return 1
     else:
-        sc_depth1 = len(exc_type1.__mro__)
-        sc_depth2 = len(exc_type2.__mro__)
+        return -1 if rank1 < rank2 else 1
 
-        if sc_depth1 == sc_depth2:
-            return -1 if exc_type1.__name__ < exc_type2.__name__ else 1
-        else:
-            return -1 if sc_depth1 < sc_depth2 else 1
+
+@functools.lru_cache(maxsize=None)
+def exc_type_rank(exc_type):
+    """
+    Return the set of an exception type's superclasses (itself included), and
+    its rank - MRO depth and name - used for ordering unrelated exception types
+    """
+    return frozenset(exc_type.__mro__), (len(exc_type.__mro__), exc_type.__name__)
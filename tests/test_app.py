@@ -0,0 +1,185 @@
+"""Tests of the Laconic application object"""
+
+import pytest
+from werkzeug.test import Client
+
+from laconic import Laconic
+from laconic.utilities import Response
+
+
+def make_app():
+    app = Laconic(__name__, config={'DEBUG': True})
+
+    @app.route('/')
+    def index() -> str:
+        return 'index'
+
+    return app
+
+
+def test_removed_event_hook_is_not_called():
+    app = make_app()
+    calls = []
+
+    def hook(context):
+        calls.append(context)
+
+    app.add_event_hook('on_context_finalize', hook)
+    client = Client(app, Response)
+
+    client.get('/')
+    assert len(calls) == 1
+
+    app.remove_event_hook('on_context_finalize', hook)
+    client.get('/')
+    assert len(calls) == 1
+    assert list(app.event_hooks['on_context_finalize']) == []
+
+
+def test_app_created_hooks_run_once_before_first_request():
+    app = make_app()
+    calls = []
+    app.add_event_hook('on_app_created', lambda: calls.append('created'))
+    app.add_event_hook('on_context_init', lambda context: calls.append('init'))
+    assert calls == []
+
+    client = Client(app, Response)
+    client.get('/')
+    client.get('/')
+    assert calls == ['created', 'init', 'init']
+
+
+def test_coroutine_event_hook_is_rejected_under_wsgi():
+    app = make_app()
+
+    async def hook(context):
+        pass
+
+    app.add_event_hook('on_context_init', hook)
+    with pytest.raises(TypeError):
+        app.trigger_event('on_context_init', None)
+
+
+def make_client():
+    app = make_app()
+
+    @app.route('/users/me')
+    def me() -> str:
+        return 'me'
+
+    @app.route('/users/<int:id>')
+    def user(id: int) -> str:
+        return 'user %d' % id
+
+    @app.route('/users/<string:name>/posts')
+    def posts(name: str) -> str:
+        return 'posts of %s' % name
+
+    @app.route('/files/<string:stem>.json')
+    def json_file(stem: str) -> str:
+        return 'json %s' % stem
+
+    @app.route('/files/<string:name>')
+    def file(name: str) -> str:
+        return 'file %s' % name
+
+    @app.route('/echo', methods=['POST'])
+    def echo(name: str) -> str:
+        return name
+
+    return Client(app, Response)
+
+
+def test_method_not_allowed_with_allow_header():
+    response = make_client().delete('/')
+    assert response.status_code == 405
+    assert set(response.headers['Allow'].split(', ')) == {'GET', 'OPTIONS'}
+
+
+def test_static_rule_takes_precedence_over_param_rule():
+    client = make_client()
+    assert client.get('/users/me').get_data(as_text=True) == 'me'
+    assert client.get('/users/5').get_data(as_text=True) == 'user 5'
+
+
+def test_first_registered_param_rule_wins():
+    client = make_client()
+    assert client.get('/users/me/posts').get_data(as_text=True) == \
+        'posts of me'
+    # The embedded-param `.json` rule is registered first, so it wins
+    assert client.get('/files/a.json').get_data(as_text=True) == 'json a'
+    assert client.get('/files/a.txt').get_data(as_text=True) == 'file a.txt'
+    assert client.post('/files/a.json').status_code == 405
+
+
+def test_json_body_with_charset():
+    response = make_client().post(
+        '/echo', data='{"name": "Žnidaršič é"}'.encode('iso-8859-2'),
+        content_type='application/json; charset=iso-8859-2')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'Žnidaršič é'
+
+    response = make_client().post(
+        '/echo', data='{"name": "café"}'.encode('latin-1'),
+        content_type='application/json; charset=latin-1')
+    assert response.get_data(as_text=True) == 'café'
+
+
+def test_failing_app_created_hook_gives_500_and_is_retried():
+    app = make_app()
+    calls = []
+
+    def hook():
+        calls.append('created')
+        if len(calls) == 1:
+            raise RuntimeError('not yet')
+
+    app.add_event_hook('on_app_created', hook)
+    client = Client(app, Response)
+
+    assert client.get('/').status_code == 500
+    assert client.get('/').status_code == 200
+    assert client.get('/').status_code == 200
+    assert calls == ['created', 'created']
+
+
+def test_first_exception_handler_for_a_type_wins():
+    app = make_app()
+
+    @app.route('/boom')
+    def boom() -> str:
+        raise ValueError('boom')
+
+    def first(exc: ValueError) -> str:
+        return 'first', 418
+
+    def second(exc: ValueError) -> str:
+        return 'second', 418
+
+    app.add_exception_handler(ValueError, first)
+    app.add_exception_handler(ValueError, second)
+
+    response = Client(app, Response).get('/boom')
+    assert (response.status_code, response.get_data(as_text=True)) == \
+        (418, 'first')
+
+
+def test_event_hook_cannot_be_added_twice():
+    app = make_app()
+    calls = []
+
+    def hook(context):
+        calls.append(context.request.method)
+
+    app.add_event_hook('on_context_finalize', hook, methods=['POST'])
+    with pytest.raises(KeyError):
+        app.add_event_hook('on_context_finalize', hook)
+
+    client = Client(app, Response)
+    client.get('/')
+    assert calls == []
+
+    app.remove_event_hook('on_context_finalize', hook)
+    app.add_event_hook('on_context_finalize', hook)
+    client.get('/')
+    assert calls == ['GET']
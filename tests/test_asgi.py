@@ -0,0 +1,147 @@
+"""Tests of the Laconic ASGI application interface"""
+
+import asyncio
+import inspect
+import json
+
+from laconic import Laconic
+
+
+def make_app():
+    app = Laconic(__name__, config={'DEBUG': True})
+
+    @app.route('/async/<int:n>')
+    async def async_endpoint(n: int) -> str:
+        await asyncio.sleep(0)
+        return 'async %d' % n
+
+    @app.route('/sync/<int:n>')
+    def sync_endpoint(n: int) -> str:
+        return 'sync %d' % n
+
+    @app.route('/boom')
+    def boom() -> str:
+        raise ValueError('boom')
+
+    @app.exception(ValueError)
+    async def handle_value_error(exc: ValueError) -> str:
+        await asyncio.sleep(0)
+        return 'handled %s' % exc, 418
+
+    @app.route('/s', methods=['POST'])
+    def post_endpoint(x: int = 1) -> str:
+        return 'x=%d' % x
+
+    return app
+
+
+def call(app, method, path, body_chunks=(b'',), headers=()):
+    """Call the ASGI `app` and return the response status, headers and body"""
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'', 'headers': list(headers),
+             'http_version': '1.1', 'scheme': 'http'}
+    messages = [{'type': 'http.request', 'body': chunk,
+                 'more_body': i < len(body_chunks) - 1}
+                for i, chunk in enumerate(body_chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.asgi(scope, receive, send))
+    return (sent[0]['status'], dict(sent[0]['headers']),
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def test_async_endpoint():
+    assert call(make_app(), 'GET', '/async/7')[::2] == (200, b'async 7')
+
+
+def test_sync_endpoint_runs_in_executor():
+    assert call(make_app(), 'GET', '/sync/7')[::2] == (200, b'sync 7')
+
+
+def test_not_found():
+    status, _, body = call(make_app(), 'GET', '/nope')
+    assert status == 404
+    assert json.loads(body.decode('utf-8'))['status_code'] == 404
+
+
+def test_chunked_body_without_content_length():
+    status, _, body = call(make_app(), 'POST', '/s', [b'{"x"', b': 9}'],
+                           [(b'content-type', b'application/json')])
+    assert (status, body) == (200, b'x=9')
+
+
+def test_body_with_content_length():
+    status, _, body = call(make_app(), 'POST', '/s', [b'{"x": 9}'],
+                           [(b'content-type', b'application/json'),
+                            (b'content-length', b'8')])
+    assert (status, body) == (200, b'x=9')
+
+
+def test_lifespan():
+    app = make_app()
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.asgi({'type': 'lifespan'}, receive, send))
+    assert [message['type'] for message in sent] == \
+        ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+def test_app_created_hooks_run_on_lifespan_startup():
+    app = make_app()
+    calls = []
+    app.add_event_hook('on_app_created', lambda: calls.append('created'))
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    asyncio.run(app.asgi({'type': 'lifespan'}, receive, send))
+    call(app, 'GET', '/sync/1')
+    assert calls == ['created']
+
+
+def test_asgi_callable_is_a_coroutine_function():
+    app = make_app()
+    assert inspect.iscoroutinefunction(app.asgi)
+    assert not inspect.iscoroutinefunction(app)
+
+
+def test_async_exception_handler():
+    assert call(make_app(), 'GET', '/boom')[::2] == (418, b'handled boom')
+
+
+def test_failing_app_created_hook_fails_lifespan_startup():
+    app = make_app()
+
+    def hook():
+        raise RuntimeError('no database')
+
+    app.add_event_hook('on_app_created', hook)
+    messages = [{'type': 'lifespan.startup'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.asgi({'type': 'lifespan'}, receive, send))
+    assert sent == [{'type': 'lifespan.startup.failed',
+                     'message': 'no database'}]
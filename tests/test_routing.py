@@ -0,0 +1,163 @@
+"""Tests of the Laconic request router"""
+
+import pytest
+
+from laconic.exceptions import APIEndpointNotFoundError, \
+    APIMethodNotAllowedError
+from laconic.routing import Router
+
+
+def user(id: int) -> str:
+    return 'user'
+
+
+def test_matched_url_params_are_read_only():
+    router = Router()
+    router.add_rule('/users/<int:id>', user, ['GET'])
+
+    endpoint, url_params = router.match_endpoint('/users/5', 'GET')
+    assert endpoint.name == 'user'
+    assert dict(url_params) == {'id': '5'}
+    with pytest.raises(TypeError):
+        url_params['id'] = '6'
+    assert dict(router.match_endpoint('/users/5', 'GET')[1]) == {'id': '5'}
+
+
+def json_file(stem: str) -> str:
+    return 'json'
+
+
+def file(name: str) -> str:
+    return 'file'
+
+
+@pytest.mark.parametrize('rules, expected', [
+    ([('/files/<string:stem>.json', json_file),
+      ('/files/<string:name>', file)], 'json_file'),
+    ([('/files/<string:name>', file),
+      ('/files/<string:stem>.json', json_file)], 'file'),
+])
+def test_registration_order_decides_between_param_rules(rules, expected):
+    router = Router()
+    for url_rule, endpoint in rules:
+        router.add_rule(url_rule, endpoint, ['GET'])
+    assert router.determine_endpoint('/files/x.json', 'GET').name == expected
+
+
+def make_endpoint(name, *params):
+    """Create an endpoint function with string parameters named `params`"""
+    namespace = {}
+    exec('def %s(%s) -> str: return %r' %
+         (name, ', '.join('%s: str' % p for p in params), name), namespace)
+    return namespace[name]
+
+
+def test_static_rule_takes_precedence_over_param_rule():
+    router = Router()
+    router.add_rule('/users/<string:id>', make_endpoint('user', 'id'), ['GET'])
+    router.add_rule('/users/me', make_endpoint('me'), ['GET'])
+
+    assert router.determine_endpoint('/users/me', 'GET').name == 'me'
+    assert router.determine_endpoint('/users/you', 'GET').name == 'user'
+
+
+def test_literal_segment_takes_precedence_over_param_segment():
+    router = Router()
+    router.add_rule('/<string:a>/posts', make_endpoint('param', 'a'), ['GET'])
+    router.add_rule('/users/<string:b>', make_endpoint('literal', 'b'), ['GET'])
+
+    assert router.determine_endpoint('/users/posts', 'GET').name == 'literal'
+    assert router.determine_endpoint('/pages/posts', 'GET').name == 'param'
+
+
+def test_backtracking_across_sibling_param_types():
+    router = Router()
+    router.add_rule('/items/<int:id>/price', make_endpoint('price', 'id'),
+                    ['GET'])
+    router.add_rule('/items/<float:id>/weight', make_endpoint('weight', 'id'),
+                    ['GET'])
+    router.add_rule('/items/<string:id>/name', make_endpoint('name', 'id'),
+                    ['GET'])
+    router.add_rule('/items/new/<int:step>', make_endpoint('new', 'step'),
+                    ['GET'])
+
+    # `new` literal branch fails on the next segment, params are tried next
+    assert router.match_endpoint('/items/new/name', 'GET')[0].name == 'name'
+    endpoint, url_params = router.match_endpoint('/items/5/weight', 'GET')
+    assert (endpoint.name, dict(url_params)) == ('weight', {'id': '5'})
+    assert router.determine_endpoint('/items/5/price', 'GET').name == 'price'
+    assert router.determine_endpoint('/items/new/3', 'GET').name == 'new'
+
+
+def test_allow_header_lists_methods_of_all_matching_rules():
+    router = Router()
+    router.add_rule('/users/<int:id>', make_endpoint('user', 'id'),
+                    ['GET', 'PUT'])
+    router.add_rule('/users/<string:name>', make_endpoint('named', 'name'),
+                    ['DELETE'])
+    router.add_rule('/users/<string:stem>.json', make_endpoint('json', 'stem'),
+                    ['GET', 'POST'])
+
+    assert set(router.get_allow_header('/users/5').split(',')) == \
+        {'GET', 'PUT', 'DELETE'}
+    assert set(router.get_available_methods('/users/5.json')) == \
+        {'GET', 'POST', 'DELETE'}
+
+
+def test_method_not_allowed_and_not_found():
+    router = Router()
+    router.add_rule('/users/<int:id>', make_endpoint('user', 'id'), ['GET'])
+
+    with pytest.raises(APIMethodNotAllowedError) as exc_info:
+        router.determine_endpoint('/users/5', 'POST')
+    assert exc_info.value.valid_methods == ['GET']
+
+    with pytest.raises(APIEndpointNotFoundError):
+        router.determine_endpoint('/users/x', 'GET')
+    with pytest.raises(APIEndpointNotFoundError):
+        router.determine_endpoint('/users/5/posts', 'GET')
+
+
+def test_cache_is_invalidated_after_add_rule():
+    router = Router()
+    router.add_rule('/users/<int:id>', make_endpoint('user', 'id'), ['GET'])
+    assert router.get_available_methods('/users/5') == ['GET']
+    with pytest.raises(APIMethodNotAllowedError):
+        router.determine_endpoint('/users/5', 'DELETE')
+
+    router.add_rule('/users/<int:id>', make_endpoint('delete', 'id'),
+                    ['DELETE'])
+    assert set(router.get_available_methods('/users/5')) == {'GET', 'DELETE'}
+    assert router.determine_endpoint('/users/5', 'DELETE').name == 'delete'
+
+    with pytest.raises(APIEndpointNotFoundError):
+        router.determine_endpoint('/users/5.json', 'GET')
+    router.add_rule('/users/<string:stem>.json',
+                    make_endpoint('json', 'stem'), ['GET'])
+    assert router.determine_endpoint('/users/5.json', 'GET').name == 'json'
+
+
+class UnhashableEndpoint:
+    __name__ = 'unhashable'
+    __hash__ = None
+
+    def __call__(self, id: int) -> str:
+        return 'unhashable'
+
+
+def test_unhashable_callable_endpoint():
+    router = Router()
+    router.add_rule('/things/<int:id>', UnhashableEndpoint(), ['GET'])
+
+    endpoint, url_params = router.match_endpoint('/things/3', 'GET')
+    assert endpoint.parameters['id'].location == 'path'
+    assert dict(url_params) == {'id': '3'}
+
+
+def test_single_method_as_a_string():
+    router = Router()
+    router.add_rule('/users/<int:id>', user, 'GET')
+
+    assert router.match_endpoint('/users/5', 'GET')[0].methods == {'GET'}
+    with pytest.raises(APIMethodNotAllowedError):
+        router.match_endpoint('/users/5', 'G')
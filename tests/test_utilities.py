@@ -0,0 +1,70 @@
+"""Tests of the Laconic utility data structures and functions"""
+
+import gc
+import json
+import weakref
+
+import pytest
+
+from laconic.exceptions import APIBadRequestError
+from laconic.utilities import AttributeScope, CombinedDict, make_json, \
+    make_exception_name
+
+
+def test_make_json_non_string_keys():
+    assert json.loads(make_json({1: 'a', 2: 'b'})) == {'1': 'a', '2': 'b'}
+
+
+def test_make_json_big_integers():
+    assert json.loads(make_json({'a': 2 ** 70})) == {'a': 2 ** 70}
+
+
+def test_verbose_error_response_with_non_string_data_keys():
+    response = APIBadRequestError('bad', data={404: 'x'}).as_response(
+        verbose=True)
+    assert response.status_code == 400
+    assert json.loads(response.get_data(as_text=True))['data'] == {'404': 'x'}
+
+
+def test_combined_dict_lookup_order_and_missing_keys():
+    combined = CombinedDict([None, [1, 'a'], {'a': 1}, {'a': 2, 'b': 3}])
+    assert (combined['a'], combined['b'], combined['c']) == (1, 3, None)
+    assert 'b' in combined and 'c' not in combined
+
+
+def test_combined_dict_is_read_only():
+    source = {'a': 1}
+    combined = CombinedDict([source])
+    with pytest.raises(TypeError):
+        combined['a'] = 2
+    assert not hasattr(combined, 'pop')
+    assert source == {'a': 1}
+
+
+def test_attribute_scope_parent_lookup():
+    parent = AttributeScope({'a': 1, 'b': 2})
+    scope = AttributeScope({'b': 3, 'n': None}, parent)
+
+    assert (scope['a'], scope['b'], scope['n'], scope['z']) == (1, 3, None, None)
+    assert 'a' in scope and 'z' not in scope
+    assert list(scope) == ['b', 'n', 'a']
+
+
+def test_make_json_indentation_does_not_depend_on_encoder():
+    # Integers out of 64-bit range are always left to the stdlib encoder
+    assert make_json({'a': 1, 'b': [2]}) == \
+        '{\n  "a": 1,\n  "b": [\n    2\n  ]\n}'
+    assert make_json({'a': 1, 'b': [2 ** 70]}) == \
+        '{\n  "a": 1,\n  "b": [\n    %d\n  ]\n}' % 2 ** 70
+
+
+def test_exception_names_do_not_keep_exception_types_alive():
+    class CustomLookupError(Exception):
+        pass
+
+    assert make_exception_name(CustomLookupError()) == 'Custom Lookup Error'
+
+    type_ref = weakref.ref(CustomLookupError)
+    del CustomLookupError
+    gc.collect()
+    assert type_ref() is None